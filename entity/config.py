@@ -62,6 +62,34 @@ class EntityConfig(object):
         """
         return True
 
+    def get_display_names(self, model_objs):
+        """
+        Returns a list of display names for a list of model objects. Defaults to
+        calling get_display_name for each model object.
+        """
+        return [self.get_display_name(model_obj) for model_obj in model_objs]
+
+    def get_entity_kinds(self, model_objs):
+        """
+        Returns a list of entity kind tuples for a list of model objects. Defaults to
+        calling get_entity_kind for each model object.
+        """
+        return [self.get_entity_kind(model_obj) for model_obj in model_objs]
+
+    def get_entity_metas(self, model_objs):
+        """
+        Returns a list of entity metadata for a list of model objects. Defaults to
+        calling get_entity_meta for each model object.
+        """
+        return [self.get_entity_meta(model_obj) for model_obj in model_objs]
+
+    def get_is_actives(self, model_objs):
+        """
+        Returns a list of active states for a list of model objects. Defaults to
+        calling get_is_active for each model object.
+        """
+        return [self.get_is_active(model_obj) for model_obj in model_objs]
+
     def get_super_entities(self, model_objs, sync_all):
         """
         Retrieves a dictionary of entity relationships. The dictionary is keyed
@@ -85,6 +113,11 @@ class EntityRegistry(object):
         # Stores a list of (model, qset_arg) tuples for each watching model
         self._entity_watching = defaultdict(list)
 
+        # Frozen snapshots of the registered and watching models. These are checked by the signal
+        # handlers on every save and are rebuilt whenever an entity config is registered
+        self._registered_models = frozenset()
+        self._watching_models = frozenset()
+
     @property
     def entity_registry(self):
         return self._entity_registry
@@ -93,6 +126,14 @@ class EntityRegistry(object):
     def entity_watching(self):
         return self._entity_watching
 
+    @property
+    def registered_models(self):
+        return self._registered_models
+
+    @property
+    def watching_models(self):
+        return self._watching_models
+
     def register_entity(self, entity_config):
         """
         Registers an entity config
@@ -111,6 +152,10 @@ class EntityRegistry(object):
         for watching_model, entity_model_getter in entity_config.watching:
             self._entity_watching[watching_model].append((model, entity_model_getter))
 
+        # Rebuild the model snapshots now that the registry changed
+        self._registered_models = frozenset(self._entity_registry)
+        self._watching_models = frozenset(self._entity_watching)
+
 
 # Define the global registry variable
 entity_registry = EntityRegistry()
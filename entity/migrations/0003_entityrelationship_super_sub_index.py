@@ -0,0 +1,17 @@
+# Generated by Django 4.2.30 on 2026-10-17 02:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('entity', '0002_entitygroup_logic_string'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='entityrelationship',
+            index=models.Index(fields=['super_entity', 'sub_entity'], name='entity_rel_super_sub_idx'),
+        ),
+    ]
@@ -1,13 +1,15 @@
 import ast
-from itertools import compress, chain
+from collections import defaultdict
+from itertools import chain, groupby
+from operator import itemgetter, or_
 
 from activatable_model.models import BaseActivatableModel, ActivatableManager, ActivatableQuerySet
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import ValidationError
 from django.core.serializers.json import DjangoJSONEncoder
-from django.db import models
-from django.db.models import Count, Q, JSONField
+from django.db import models, transaction
+from django.db.models import Count, Exists, OuterRef, Prefetch, Q, JSONField
 from python3_utils import compare_on_attr
 from functools import reduce
 
@@ -83,17 +85,21 @@ class EntityQuerySet(ActivatableQuerySet):
         Given a list of super entities, return the entities that have those as a subset of their super entities.
         """
         if super_entities:
-            if len(super_entities) == 1:
-                # Optimize for the case of just one super entity since this is a much less intensive query
-                has_subset = EntityRelationship.objects.filter(
-                    super_entity=super_entities[0]).values_list('sub_entity', flat=True)
-            else:
-                # Get a list of entities that have super entities with all types
-                has_subset = EntityRelationship.objects.filter(
-                    super_entity__in=super_entities).values('sub_entity').annotate(Count('super_entity')).filter(
-                    super_entity__count=len(set(super_entities))).values_list('sub_entity', flat=True)
-
-            return self.filter(id__in=has_subset)
+            # Compare primary keys rather than hashing the entity models
+            super_entity_ids = {getattr(super_entity, 'pk', super_entity) for super_entity in super_entities}
+            if len(super_entity_ids) == 1:
+                # Having a single super entity is the same as having any of them, which does not need grouping
+                return self.is_sub_to_any(*super_entity_ids)
+
+            # Group only the relationships to the given super entities and keep the sub entities that
+            # have all of them
+            return self.filter(pk__in=EntityRelationship.objects.filter(
+                super_entity_id__in=super_entity_ids
+            ).values('sub_entity').annotate(
+                super_entity_match_count=Count('super_entity', distinct=True)
+            ).filter(
+                super_entity_match_count=len(super_entity_ids)
+            ).values('sub_entity'))
         else:
             return self
 
@@ -102,8 +108,9 @@ class EntityQuerySet(ActivatableQuerySet):
         Given a list of super entities, return the entities that have super entities that interset with those provided.
         """
         if super_entities:
-            return self.filter(id__in=EntityRelationship.objects.filter(
-                super_entity__in=super_entities).values_list('sub_entity', flat=True))
+            # A semi-join lets the database stop at the first matching relationship of each entity
+            return self.filter(Exists(EntityRelationship.objects.filter(
+                sub_entity=OuterRef('pk'), super_entity__in=super_entities)))
         else:
             return self
 
@@ -112,18 +119,21 @@ class EntityQuerySet(ActivatableQuerySet):
         Each returned entity will have superentites whos combined entity_kinds included *super_entity_kinds
         """
         if super_entity_kinds:
-            if len(super_entity_kinds) == 1:
-                # Optimize for the case of just one
-                has_subset = EntityRelationship.objects.filter(
-                    super_entity__entity_kind=super_entity_kinds[0]).values_list('sub_entity', flat=True)
-            else:
-                # Get a list of entities that have super entities with all types
-                has_subset = EntityRelationship.objects.filter(
-                    super_entity__entity_kind__in=super_entity_kinds).values('sub_entity').annotate(
-                    Count('super_entity')).filter(super_entity__count=len(set(super_entity_kinds))).values_list(
-                    'sub_entity', flat=True)
-
-            return self.filter(pk__in=has_subset)
+            super_entity_kind_ids = {
+                getattr(super_entity_kind, 'pk', super_entity_kind) for super_entity_kind in super_entity_kinds
+            }
+            if len(super_entity_kind_ids) == 1:
+                return self.is_sub_to_any_kind(*super_entity_kind_ids)
+
+            # Count the distinct matching kinds since an entity can have more than one super entity of
+            # the same kind
+            return self.filter(pk__in=EntityRelationship.objects.filter(
+                super_entity__entity_kind__in=super_entity_kind_ids
+            ).values('sub_entity').annotate(
+                super_entity_kind_match_count=Count('super_entity__entity_kind', distinct=True)
+            ).filter(
+                super_entity_kind_match_count=len(super_entity_kind_ids)
+            ).values('sub_entity'))
         else:
             return self
 
@@ -132,27 +142,47 @@ class EntityQuerySet(ActivatableQuerySet):
         Find all entities that have super_entities of any of the specified kinds
         """
         if super_entity_kinds:
-            # get the pks of the desired subs from the relationships table
-            if len(super_entity_kinds) == 1:
-                entity_pks = EntityRelationship.objects.filter(
-                    super_entity__entity_kind=super_entity_kinds[0]
-                ).select_related('entity_kind', 'sub_entity').values_list('sub_entity', flat=True)
-            else:
-                entity_pks = EntityRelationship.objects.filter(
-                    super_entity__entity_kind__in=super_entity_kinds
-                ).select_related('entity_kind', 'sub_entity').values_list('sub_entity', flat=True)
-            # return a queryset limited to only those pks
-            return self.filter(pk__in=entity_pks)
+            # A semi-join returns each entity once without a distinct
+            return self.filter(Exists(EntityRelationship.objects.filter(
+                sub_entity=OuterRef('pk'), super_entity__entity_kind__in=super_entity_kinds)))
         else:
             return self
 
-    def cache_relationships(self, cache_super=True, cache_sub=True):
+    def cache_relationships(self, cache_super=True, cache_sub=True, cache_entity_models=False, defer_meta=False):
+        """
+        Caches the super and sub relationships by doing a prefetch_related. The related entities are joined
+        into the relationship query. If defer_meta is True, their metadata is deferred for traversals that do not
+        need it. If cache_entity_models is True, the model objects of the entities and of the cached related
+        entities are prefetched too, with one query per content type.
+        """
+        lookups_to_cache = []
+        if cache_entity_models:
+            lookups_to_cache.append('entity')
+        if cache_super:
+            super_relationships = EntityRelationship.objects.select_related('super_entity')
+            if defer_meta:
+                super_relationships = super_relationships.defer('super_entity__entity_meta')
+            if cache_entity_models:
+                super_relationships = super_relationships.prefetch_related('super_entity__entity')
+            lookups_to_cache.append(Prefetch('super_relationships', queryset=super_relationships))
+        if cache_sub:
+            sub_relationships = EntityRelationship.objects.select_related('sub_entity')
+            if defer_meta:
+                sub_relationships = sub_relationships.defer('sub_entity__entity_meta')
+            if cache_entity_models:
+                sub_relationships = sub_relationships.prefetch_related('sub_entity__entity')
+            lookups_to_cache.append(Prefetch('sub_relationships', queryset=sub_relationships))
+
+        if not lookups_to_cache:
+            return self
+        return self.prefetch_related(*lookups_to_cache)
+
+    def defer_meta(self):
         """
-        Caches the super and sub relationships by doing a prefetch_related.
+        Defers loading the entity_meta of the entities. Useful when fetching many entities whose metadata
+        is not needed since it is usually the widest column and has to be decoded for every row.
         """
-        relationships_to_cache = compress(
-            ['super_relationships__super_entity', 'sub_relationships__sub_entity'], [cache_super, cache_sub])
-        return self.prefetch_related(*relationships_to_cache)
+        return self.defer('entity_meta')
 
 
 class AllEntityManager(ActivatableManager):
@@ -178,6 +208,32 @@ class AllEntityManager(ActivatableManager):
                 entity_model_obj, for_concrete_model=False), entity_id=entity_model_obj.id).delete(
             force=True)
 
+    def filter_for_objs(self, entity_model_objs):
+        """
+        Given saved entity model objects, return the associated entities. The objects are grouped by their model
+        class so that the entities are looked up with a single filter.
+        """
+        entity_ids_by_model_class = defaultdict(list)
+        for entity_model_obj in entity_model_objs:
+            entity_ids_by_model_class[type(entity_model_obj)].append(entity_model_obj.id)
+
+        if not entity_ids_by_model_class:
+            return self.none()
+
+        return self.filter(reduce(or_, [
+            Q(
+                entity_type=ContentType.objects.get_for_model(model_class, for_concrete_model=False),
+                entity_id__in=entity_ids
+            )
+            for model_class, entity_ids in entity_ids_by_model_class.items()
+        ]))
+
+    def bulk_delete_for_objs(self, entity_model_objs):
+        """
+        Delete the entities associated with many model objects with a single query.
+        """
+        return self.filter_for_objs(entity_model_objs).delete(force=True)
+
     def active(self):
         """
         Returns active entities.
@@ -227,11 +283,19 @@ class AllEntityManager(ActivatableManager):
         """
         return self.get_queryset().is_sub_to_any(*super_entities)
 
-    def cache_relationships(self, cache_super=True, cache_sub=True):
+    def cache_relationships(self, cache_super=True, cache_sub=True, cache_entity_models=False, defer_meta=False):
         """
         Caches the super and sub relationships by doing a prefetch_related.
         """
-        return self.get_queryset().cache_relationships(cache_super=cache_super, cache_sub=cache_sub)
+        return self.get_queryset().cache_relationships(
+            cache_super=cache_super, cache_sub=cache_sub, cache_entity_models=cache_entity_models,
+            defer_meta=defer_meta)
+
+    def defer_meta(self):
+        """
+        Defers loading the entity_meta of the entities.
+        """
+        return self.get_queryset().defer_meta()
 
 
 class ActiveEntityManager(AllEntityManager):
@@ -272,19 +336,29 @@ class Entity(BaseActivatableModel):
     class Meta:
         unique_together = ('entity_id', 'entity_type')
 
+    def _get_relationships(self, related_name, entity_field):
+        """
+        Returns the relationships for the related name. The relationships cached by cache_relationships are used
+        when present, otherwise the related entities are joined in so that they are fetched with a single query.
+        """
+        relationships = getattr(self, related_name)
+        if related_name in getattr(self, '_prefetched_objects_cache', {}):
+            return relationships.all()
+        return relationships.select_related(entity_field)
+
     def get_sub_entities(self):
         """
         Returns all of the sub entities of this entity. The returned entities may be filtered by chaining any
         of the functions in EntityFilter.
         """
-        return [r.sub_entity for r in self.sub_relationships.all()]
+        return [r.sub_entity for r in self._get_relationships('sub_relationships', 'sub_entity')]
 
     def get_super_entities(self):
         """
         Returns all of the super entities of this entity. The returned super entities may be filtered by
         chaining methods from EntityFilter.
         """
-        return [r.super_entity for r in self.super_relationships.all()]
+        return [r.super_entity for r in self._get_relationships('super_relationships', 'super_entity')]
 
     def __str__(self):
         """Return the display_name field
@@ -301,6 +375,11 @@ class EntityRelationship(models.Model):
 
     class Meta:
         unique_together = ('sub_entity', 'super_entity')
+        indexes = [
+            # The unique constraint covers lookups by sub entity. This covers the reverse direction so that
+            # fetching the subs of a set of super entities can be answered from the index alone
+            models.Index(fields=['super_entity', 'sub_entity'], name='entity_rel_super_sub_idx'),
+        ]
 
     # The sub entity. The related name is called super_relationships since
     # querying this reverse relationship returns all of the relationships
@@ -318,23 +397,23 @@ class EntityGroupManager(models.Manager):
     def get_membership_cache(self, group_ids=None, is_active=True):
         """
         Build a dict cache with the group membership info. Keyed off the group id and the values are
-        a 2 element list of entity id and entity kind id (same values as the membership model). If no group ids
+        a 2 element tuple of entity id and entity kind id (same values as the membership model). If no group ids
         are passed, then all groups will be fetched
 
         :param is_active: Flag indicating whether to filter on entity active status. None will not filter.
         :rtype: dict
         """
-        membership_queryset = EntityGroupMembership.objects.filter(
-            # Select all memberships that are defined by a sub entity kind only
-            Q(entity__isnull=True) |
-            # Select memberships that define a single entity (null kind) and respect active flag
-            (Q(entity__isnull=False) & Q(sub_entity_kind__isnull=True) & Q(entity__is_active=is_active)) |
-            # Select memberships that are all of a kind under an entity and only query active supers
-            (Q(entity__isnull=False) & Q(sub_entity_kind__isnull=False) & Q(entity__is_active=True))
-        )
+        membership_queryset = EntityGroupMembership.objects.all()
 
-        if is_active is None:
-            membership_queryset = EntityGroupMembership.objects.all()
+        if is_active is not None:
+            membership_queryset = membership_queryset.filter(
+                # Select all memberships that are defined by a sub entity kind only
+                Q(entity__isnull=True) |
+                # Select memberships that define a single entity (null kind) and respect active flag
+                (Q(entity__isnull=False) & Q(sub_entity_kind__isnull=True) & Q(entity__is_active=is_active)) |
+                # Select memberships that are all of a kind under an entity and only query active supers
+                (Q(entity__isnull=False) & Q(sub_entity_kind__isnull=False) & Q(entity__is_active=True))
+            )
 
         if group_ids:
             membership_queryset = membership_queryset.filter(entity_group_id__in=group_ids)
@@ -343,13 +422,13 @@ class EntityGroupManager(models.Manager):
 
         membership_queryset = membership_queryset.values_list('entity_group_id', 'entity_id', 'sub_entity_kind_id')
 
-        # Iterate over the query results and build the cache dict
-        membership_cache = {}
-        for entity_group_id, entity_id, sub_entity_kind_id in membership_queryset:
-            membership_cache.setdefault(entity_group_id, [])
-            membership_cache[entity_group_id].append([entity_id, sub_entity_kind_id])
+        # Iterate over the query results and build the cache dict. The results are streamed since groups
+        # can have a very large number of memberships
+        membership_cache = defaultdict(list)
+        for entity_group_id, entity_id, sub_entity_kind_id in membership_queryset.iterator(chunk_size=5000):
+            membership_cache[entity_group_id].append((entity_id, sub_entity_kind_id))
 
-        return membership_cache
+        return dict(membership_cache)
 
 
 class EntityGroup(models.Model):
@@ -382,6 +461,43 @@ class EntityGroup(models.Model):
         """
         return self.get_all_entities(return_models=True, is_active=is_active)
 
+    @classmethod
+    def bulk_all_entities(cls, entity_groups, is_active=True, return_models=False):
+        """
+        Return the entities of many groups. The membership cache and entities by kind are built once for all of
+        the groups instead of once per group.
+
+        :param entity_groups: The entity groups to fetch entities for
+        :param is_active: Flag to control entities being returned. Defaults to True for active entities only
+        :param return_models: If True, the values are Entity querysets, if False, they are sets of entity ids
+        :return: A dict keyed on each entity group with the entities of that group
+        :rtype: dict
+        """
+        entity_groups = list(entity_groups)
+        if not entity_groups:
+            return {}
+
+        membership_cache = cls.objects.get_membership_cache(
+            [entity_group.id for entity_group in entity_groups], is_active=is_active
+        )
+
+        # The entities by kind are only needed for logic strings and memberships with a kind
+        entities_by_kind = {}
+        if any(entity_group.logic_string for entity_group in entity_groups) or any(
+            entity_kind_id for memberships in membership_cache.values() for _, entity_kind_id in memberships
+        ):
+            entities_by_kind = get_entities_by_kind(membership_cache=membership_cache, is_active=is_active)
+
+        return {
+            entity_group: entity_group.get_all_entities(
+                membership_cache=membership_cache,
+                entities_by_kind=entities_by_kind,
+                return_models=return_models,
+                is_active=is_active,
+            )
+            for entity_group in entity_groups
+        }
+
     def get_filter_indices(self, node):
         """
         Makes sure that each filter referenced actually exists
@@ -497,17 +613,22 @@ class EntityGroup(models.Model):
         if membership_cache is None:
             membership_cache = EntityGroup.objects.get_membership_cache([self.id], is_active=is_active)
 
+        memberships = membership_cache.get(self.id)
+
+        # The entities by kind are only needed for logic strings and memberships with a kind
         if entities_by_kind is None:
-            entities_by_kind = entities_by_kind or get_entities_by_kind(
-                membership_cache=membership_cache,
-                is_active=is_active,
-            )
+            if self.logic_string or any(entity_kind_id for _, entity_kind_id in memberships or ()):
+                entities_by_kind = get_entities_by_kind(
+                    membership_cache=membership_cache,
+                    is_active=is_active,
+                )
+            else:
+                entities_by_kind = {}
 
         # Build set of all entity ids for this group
         entity_ids = set()
 
         # This group does have entities
-        memberships = membership_cache.get(self.id)
         if memberships:
             if self.logic_string:
                 entity_ids = self.get_entity_ids_from_logic_string(entities_by_kind, memberships)
@@ -596,7 +717,7 @@ class EntityGroup(models.Model):
             entity=entity,
             sub_entity_kind=sub_entity_kind,
         ) for entity, sub_entity_kind in entities_and_kinds]
-        created = EntityGroupMembership.objects.bulk_create(memberships)
+        created = EntityGroupMembership.objects.bulk_create(memberships, batch_size=1000)
         return created
 
     def remove_entity(self, entity, sub_entity_kind=None):
@@ -627,29 +748,102 @@ class EntityGroup(models.Model):
             can be ``None``, to add a single entity, or some entity
             kind to add all sub-entities of that kind.
         """
-        criteria = [
-            Q(entity=entity, sub_entity_kind=entity_kind)
+        self._remove_memberships([
+            (entity.id if entity else None, entity_kind.id if entity_kind else None)
             for entity, entity_kind in entities_and_kinds
-        ]
-        criteria = reduce(lambda q1, q2: q1 | q2, criteria, Q())
-        EntityGroupMembership.objects.filter(
-            criteria, entity_group=self).delete()
+        ])
 
+    def _remove_memberships(self, entity_and_kind_ids):
+        """
+        Remove the memberships of this EntityGroup that match the given (entity id, entity kind id) pairs.
+        """
+        # Partition the pairs by which side is null since null values can not be matched in a tuple comparison
+        entity_and_kind_id_pairs = set()
+        entity_ids = set()
+        entity_kind_ids = set()
+        remove_null_memberships = False
+        for entity_id, entity_kind_id in entity_and_kind_ids:
+            if entity_id is not None and entity_kind_id is not None:
+                entity_and_kind_id_pairs.add((entity_id, entity_kind_id))
+            elif entity_id is not None:
+                entity_ids.add(entity_id)
+            elif entity_kind_id is not None:
+                entity_kind_ids.add(entity_kind_id)
+            else:
+                remove_null_memberships = True
+
+        criteria = []
+        if entity_and_kind_id_pairs:
+            # Match the pairs with a single composite IN instead of an OR clause per pair
+            criteria.append(Q(id__in=EntityGroupMembership.objects.extra(
+                where=['(entity_id, sub_entity_kind_id) IN %s'],
+                params=[tuple(entity_and_kind_id_pairs)]
+            ).values('id')))
+        if entity_ids:
+            criteria.append(Q(entity_id__in=entity_ids, sub_entity_kind__isnull=True))
+        if entity_kind_ids:
+            criteria.append(Q(entity__isnull=True, sub_entity_kind_id__in=entity_kind_ids))
+        if remove_null_memberships:
+            criteria.append(Q(entity__isnull=True, sub_entity_kind__isnull=True))
+
+        if criteria:
+            EntityGroupMembership.objects.filter(
+                reduce(or_, criteria), entity_group=self).delete()
+
+    @transaction.atomic
     def bulk_overwrite(self, entities_and_kinds):
         """
         Update the group to the given entities and sub-entity groups.
 
         After this operation, the only members of this EntityGroup
-        will be the given entities, and sub-entity groups.
+        will be the given entities, and sub-entity groups. Memberships
+        that are already in the group are reused, so only the missing
+        memberships are created and the others are removed. The
+        removals and additions happen in a single transaction.
 
         :type entities_and_kinds: List of (Entity, EntityKind) pairs.
         :param entities_and_kinds: A list of entity, entity-kind pairs
             to set to the EntityGroup. In the pairs the entity-kind
             can be ``None``, to add a single entity, or some entity
             kind to add all sub-entities of that kind.
-        """
-        EntityGroupMembership.objects.filter(entity_group=self).delete()
-        return self.bulk_add_entities(entities_and_kinds)
+        :return: The memberships of the given pairs, in the given order
+        """
+        # Logic strings reference memberships by their order, so the memberships are always recreated
+        if self.logic_string:
+            EntityGroupMembership.objects.filter(entity_group=self).delete()
+            return self.bulk_add_entities(entities_and_kinds)
+
+        existing_memberships = defaultdict(list)
+        for membership in EntityGroupMembership.objects.filter(entity_group=self).order_by('id'):
+            existing_memberships[(membership.entity_id, membership.sub_entity_kind_id)].append(membership)
+
+        # Reuse an existing membership for each pair when there is one left and create the others
+        memberships = []
+        memberships_to_create = []
+        for entity, entity_kind in entities_and_kinds:
+            entity_and_kind_id = (entity.id if entity else None, entity_kind.id if entity_kind else None)
+            if existing_memberships.get(entity_and_kind_id):
+                memberships.append(existing_memberships[entity_and_kind_id].pop(0))
+            else:
+                membership = EntityGroupMembership(
+                    entity_group=self,
+                    entity_id=entity_and_kind_id[0],
+                    sub_entity_kind_id=entity_and_kind_id[1],
+                )
+                memberships.append(membership)
+                memberships_to_create.append(membership)
+
+        # Remove the memberships that were not reused, including duplicates of reused ones
+        membership_ids_to_remove = [
+            membership.id
+            for memberships_for_pair in existing_memberships.values()
+            for membership in memberships_for_pair
+        ]
+        if membership_ids_to_remove:
+            EntityGroupMembership.objects.filter(id__in=membership_ids_to_remove).delete()
+        EntityGroupMembership.objects.bulk_create(memberships_to_create, batch_size=1000)
+
+        return memberships
 
 
 @compare_on_attr()
@@ -750,11 +944,16 @@ def get_entities_by_kind(membership_cache=None, is_active=True):
     if is_active is not None:
         all_entities_for_types = all_entities_for_types.filter(is_active=is_active)
 
-    all_entities_for_types = all_entities_for_types.values_list('id', 'entity_kind_id')
+    # The rows are streamed in chunks to bound memory
+    all_entities_for_types = all_entities_for_types.order_by(
+        'entity_kind_id', 'id'
+    ).values_list(
+        'id', 'entity_kind_id'
+    ).iterator(chunk_size=10000)
 
-    # Add entity ids to entity kind's all list
-    for id, entity_kind_id in all_entities_for_types:
-        entities_by_kind[entity_kind_id]['all'].append(id)
+    # Set the entity ids of each entity kind's all list
+    for entity_kind_id, rows in groupby(all_entities_for_types, key=itemgetter(1)):
+        entities_by_kind[entity_kind_id]['all'] = [row[0] for row in rows]
 
     # Get relationships for memberships defined by all of a kind under a super
     relationships = EntityRelationship.objects.filter(
@@ -766,13 +965,14 @@ def get_entities_by_kind(membership_cache=None, is_active=True):
     if is_active is not None:
         relationships = relationships.filter(sub_entity__is_active=is_active)
 
-    relationships = relationships.values_list(
+    relationships = relationships.order_by(
+        'sub_entity__entity_kind_id', 'super_entity_id', 'sub_entity_id'
+    ).values_list(
         'super_entity_id', 'sub_entity_id', 'sub_entity__entity_kind_id'
-    )
+    ).iterator(chunk_size=10000)
 
-    # Add entity ids to each super entity's list
-    for super_entity_id, sub_entity_id, sub_entity__entity_kind_id in relationships:
-        entities_by_kind[sub_entity__entity_kind_id].setdefault(super_entity_id, [])
-        entities_by_kind[sub_entity__entity_kind_id][super_entity_id].append(sub_entity_id)
+    # Set the entity ids of each super entity's list
+    for (sub_entity__entity_kind_id, super_entity_id), rows in groupby(relationships, key=itemgetter(2, 0)):
+        entities_by_kind[sub_entity__entity_kind_id][super_entity_id] = [row[1] for row in rows]
 
     return entities_by_kind
@@ -11,7 +11,7 @@ def delete_entity_signal_handler(sender, instance, **kwargs):
     Defines a signal handler for syncing an individual entity. Called when
     an entity is saved or deleted.
     """
-    if instance.__class__ in entity_registry.entity_registry:
+    if instance.__class__ in entity_registry.registered_models:
         Entity.all_objects.delete_for_obj(instance)
 
 
@@ -20,10 +20,10 @@ def save_entity_signal_handler(sender, instance, **kwargs):
     Defines a signal handler for saving an entity. Syncs the entity to
     the entity mirror table.
     """
-    if instance.__class__ in entity_registry.entity_registry:
+    if instance.__class__ in entity_registry.registered_models:
         sync_entities(instance)
 
-    if instance.__class__ in entity_registry.entity_watching:
+    if instance.__class__ in entity_registry.watching_models:
         sync_entities_watching(instance)
 
 
@@ -44,10 +44,24 @@ def bulk_operation_signal_handler(sender, *args, **kwargs):
     syncing of all entities. It is up to the user to explicitly enable syncing on bulk
     operations with turn_on_syncing(bulk=True)
     """
-    if sender in entity_registry.entity_registry:
+    if sender in entity_registry.registered_models:
         sync_entities()
 
 
+def _get_syncing_signal_handlers(for_post_save, for_post_delete, for_m2m_changed, for_post_bulk_operation):
+    """
+    Returns the (signal, handler) pairs used for syncing entities that are selected by the flags. The dispatch
+    uid of each handler is its name.
+    """
+    signal_handlers = [
+        (for_post_save, post_save, save_entity_signal_handler),
+        (for_post_delete, post_delete, delete_entity_signal_handler),
+        (for_m2m_changed, m2m_changed, m2m_changed_entity_signal_handler),
+        (for_post_bulk_operation, post_bulk_operation, bulk_operation_signal_handler),
+    ]
+    return [(signal, handler) for enabled, signal, handler in signal_handlers if enabled]
+
+
 def turn_off_syncing(for_post_save=True, for_post_delete=True, for_m2m_changed=True, for_post_bulk_operation=True):
     """
     Disables all of the signals for syncing entities. By default, everything is turned off. If the user wants
@@ -55,14 +69,9 @@ def turn_off_syncing(for_post_save=True, for_post_delete=True, for_m2m_changed=T
 
     turn_off_sync(for_post_save=False)
     """
-    if for_post_save:
-        post_save.disconnect(save_entity_signal_handler, dispatch_uid='save_entity_signal_handler')
-    if for_post_delete:
-        post_delete.disconnect(delete_entity_signal_handler, dispatch_uid='delete_entity_signal_handler')
-    if for_m2m_changed:
-        m2m_changed.disconnect(m2m_changed_entity_signal_handler, dispatch_uid='m2m_changed_entity_signal_handler')
-    if for_post_bulk_operation:
-        post_bulk_operation.disconnect(bulk_operation_signal_handler, dispatch_uid='bulk_operation_signal_handler')
+    for signal, handler in _get_syncing_signal_handlers(
+            for_post_save, for_post_delete, for_m2m_changed, for_post_bulk_operation):
+        signal.disconnect(handler, dispatch_uid=handler.__name__)
 
 
 def turn_on_syncing(for_post_save=True, for_post_delete=True, for_m2m_changed=True, for_post_bulk_operation=False):
@@ -72,14 +81,9 @@ def turn_on_syncing(for_post_save=True, for_post_delete=True, for_m2m_changed=Tr
     result in every single entity being synced again. This is not a desired behavior by the majority of users, and
     should only be turned on explicitly.
     """
-    if for_post_save:
-        post_save.connect(save_entity_signal_handler, dispatch_uid='save_entity_signal_handler')
-    if for_post_delete:
-        post_delete.connect(delete_entity_signal_handler, dispatch_uid='delete_entity_signal_handler')
-    if for_m2m_changed:
-        m2m_changed.connect(m2m_changed_entity_signal_handler, dispatch_uid='m2m_changed_entity_signal_handler')
-    if for_post_bulk_operation:
-        post_bulk_operation.connect(bulk_operation_signal_handler, dispatch_uid='bulk_operation_signal_handler')
+    for signal, handler in _get_syncing_signal_handlers(
+            for_post_save, for_post_delete, for_m2m_changed, for_post_bulk_operation):
+        signal.connect(handler, dispatch_uid=handler.__name__)
 
 
 # Connect all default signal handlers
@@ -7,9 +7,11 @@ from time import sleep
 
 import wrapt
 from collections import defaultdict
+from itertools import chain
 
 from activatable_model import model_activations_changed
 from django import db
+from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
 import manager_utils
 from django.db import transaction, connection
@@ -185,6 +187,36 @@ def _fetch_entity_models(model_ids_to_sync, model_objs_map, model_objs_by_ctype,
                 model_objs_map[(ctype, model_obj.id)] = model_obj
 
 
+def _get_config_values(entity_config, hook_name, model_objs):
+    """
+    Calls one of the list hooks of an entity config and ensures that it returned a value for every model object
+    """
+    values = list(getattr(entity_config, hook_name)(model_objs))
+    if len(values) != len(model_objs):
+        raise ValueError('{0}.{1} returned {2} values for {3} model objects'.format(
+            entity_config.__class__.__name__, hook_name, len(values), len(model_objs)
+        ))
+    return values
+
+
+def _get_models_from_upsert_results(queryset, upsert_results):
+    """
+    Builds model objects from the rows returned by a bulk upsert so that callers get models
+    no matter how the rows were upserted
+    """
+    model = queryset.model
+    db_connection = db.connections[queryset.db]
+    fields = model._meta.concrete_fields
+    return [
+        model.from_db(queryset.db, [field.attname for field in fields], [
+            field.from_db_value(getattr(row, field.column), None, db_connection)
+            if hasattr(field, 'from_db_value') else getattr(row, field.column)
+            for field in fields
+        ])
+        for row in upsert_results
+    ]
+
+
 def _get_model_objs_to_sync(model_ids_to_sync, model_objs_map, model_objs_by_ctype, sync_all):
     """
     Given the model IDs to sync, fetch all model objects to sync
@@ -241,12 +273,15 @@ sync_entities.suppress = False
 
 def sync_entities_watching(instance):
     """
-    Syncs entities watching changes of a model instance.
+    Syncs entities watching changes of a model instance. The model objects of all of the watching entities are
+    synced together in a single pass.
     """
+    model_objs = []
     for entity_model, entity_model_getter in entity_registry.entity_watching[instance.__class__]:
-        model_objs = list(entity_model_getter(instance))
-        if model_objs:
-            sync_entities(*model_objs)
+        model_objs.extend(entity_model_getter(instance))
+
+    if model_objs:
+        sync_entities(*model_objs)
 
 
 class EntitySyncer(object):
@@ -254,6 +289,10 @@ class EntitySyncer(object):
     A class that will handle the syncing of entities
     """
 
+    # The default number of entities and relationships written per batch when syncing selected entities.
+    # It can be changed with the ENTITY_SYNC_BATCH_SIZE setting
+    upsert_batch_size = 10000
+
     def __init__(self, *model_objs):
         """
         Initialize the entity syncer with the models we need to sync
@@ -262,6 +301,9 @@ class EntitySyncer(object):
         # Set the model objects
         self.model_objs = model_objs
 
+        # Set the batch size
+        self.upsert_batch_size = getattr(settings, 'ENTITY_SYNC_BATCH_SIZE', self.upsert_batch_size)
+
         # Are we syncing all
         self.sync_all = not model_objs
 
@@ -279,23 +321,25 @@ class EntitySyncer(object):
 
         # If we are syncing all build the entire map for all entity types
         if self.sync_all:
+            # Load the content types of every registered model in one query
+            ctypes_by_model_class = ContentType.objects.get_for_models(
+                *entity_registry.entity_registry, for_concrete_models=False
+            )
             for model_class, entity_config in entity_registry.entity_registry.items():
                 model_qset = entity_config.queryset
+                ctype = ctypes_by_model_class[model_class]
                 model_objs_map.update({
-                    (ContentType.objects.get_for_model(model_class, for_concrete_model=False), model_obj.id): model_obj
+                    (ctype, model_obj.id): model_obj
                     for model_obj in model_qset.all()
                 })
 
-        # Organize by content type
+        # Organize by content type and build a dict of all entities that need to be synced. These
+        # include the original models and any super entities from super_entities_by_ctype. This
+        # dict is keyed on ctype with a list of IDs of each model
         model_objs_by_ctype = defaultdict(list)
-        for (ctype, model_id), model_obj in model_objs_map.items():
-            model_objs_by_ctype[ctype].append(model_obj)
-
-        # Build a dict of all entities that need to be synced. These include the original models
-        # and any super entities from super_entities_by_ctype. This dict is keyed on ctype with
-        # a list of IDs of each model
         model_ids_to_sync = defaultdict(set)
         for (ctype, model_id), model_obj in model_objs_map.items():
+            model_objs_by_ctype[ctype].append(model_obj)
             model_ids_to_sync[ctype].add(model_obj.id)
 
         # For each ctype, obtain super entities. This is a dict keyed on ctype. Each value
@@ -308,12 +352,19 @@ class EntitySyncer(object):
         # everything and can fill in this data struct without doing another DB hit
         model_objs_to_sync = _get_model_objs_to_sync(model_ids_to_sync, model_objs_map, model_objs_by_ctype, sync_all)
 
-        # Obtain all entity kind tuples associated with the models
-        entity_kind_tuples_to_sync = set()
-        for ctype, model_objs_to_sync_for_ctype in model_objs_to_sync.items():
-            entity_config = entity_registry.entity_registry.get(ctype.model_class())
-            for model_obj in model_objs_to_sync_for_ctype:
-                entity_kind_tuples_to_sync.add(entity_config.get_entity_kind(model_obj))
+        # Look up the entity config of each content type once
+        entity_configs_by_ctype = {
+            ctype: entity_registry.entity_registry.get(ctype.model_class())
+            for ctype in model_objs_to_sync
+        }
+
+        # Obtain the entity kind tuples of the models once. They are kept per content type
+        # so that the entities can be built from them after the kinds are upserted
+        entity_kind_tuples_by_ctype = {
+            ctype: _get_config_values(entity_configs_by_ctype[ctype], 'get_entity_kinds', model_objs_to_sync_for_ctype)
+            for ctype, model_objs_to_sync_for_ctype in model_objs_to_sync.items()
+        }
+        entity_kind_tuples_to_sync = set(chain.from_iterable(entity_kind_tuples_by_ctype.values()))
 
         # Build the entity kinds that we need to sync
         entity_kinds_to_upsert = [
@@ -326,26 +377,37 @@ class EntitySyncer(object):
             entity_kinds=entity_kinds_to_upsert
         )
 
-        # Build a map of entity kind name to entity kind
-        entity_kinds_map = {
-            entity_kind.name: entity_kind
+        # Build a map of entity kind name to entity kind id
+        entity_kind_ids_by_name = {
+            entity_kind.name: entity_kind.id
             for entity_kind in upserted_entity_kinds
         }
 
-        # Now that we have all entity kinds, build all entities that need to be synced
+        # Now that we have all entity kinds, build all entities that need to be synced. The
+        # config hooks are called once per content type with every model object of that type
         entities_to_upsert = []
         for ctype, model_objs_to_sync_for_ctype in model_objs_to_sync.items():
-            entity_config = entity_registry.entity_registry.get(ctype.model_class())
+            entity_config = entity_configs_by_ctype[ctype]
+            entity_kind_ids = [
+                entity_kind_ids_by_name[name]
+                for name, display_name in entity_kind_tuples_by_ctype[ctype]
+            ]
             entities_to_upsert.extend([
                 Entity(
                     entity_id=model_obj.id,
                     entity_type_id=ctype.id,
-                    entity_kind_id=entity_kinds_map[entity_config.get_entity_kind(model_obj)[0]].id,
-                    entity_meta=entity_config.get_entity_meta(model_obj),
-                    display_name=entity_config.get_display_name(model_obj),
-                    is_active=entity_config.get_is_active(model_obj)
+                    entity_kind_id=entity_kind_id,
+                    entity_meta=entity_meta,
+                    display_name=display_name,
+                    is_active=is_active
+                )
+                for model_obj, entity_kind_id, entity_meta, display_name, is_active in zip(
+                    model_objs_to_sync_for_ctype,
+                    entity_kind_ids,
+                    _get_config_values(entity_config, 'get_entity_metas', model_objs_to_sync_for_ctype),
+                    _get_config_values(entity_config, 'get_display_names', model_objs_to_sync_for_ctype),
+                    _get_config_values(entity_config, 'get_is_actives', model_objs_to_sync_for_ctype)
                 )
-                for model_obj in model_objs_to_sync_for_ctype
             ])
 
         # Upsert the entities and get the upserted entities and the changed state
@@ -357,45 +419,59 @@ class EntitySyncer(object):
         # Call the model activations changed signal manually since we have done a bulk operation
         self.send_entity_activation_events(changed_entity_activation_state)
 
-        # Create a map out of entities
-        entities_map = {
-            (entity.entity_type_id, entity.entity_id): entity
-            for entity in upserted_entities
-        }
+        # Create a map of entity ids keyed on the entity type id and then the model id
+        entity_ids_by_ctype_id = defaultdict(dict)
+        for entity in upserted_entities:
+            entity_ids_by_ctype_id[entity.entity_type_id][entity.entity_id] = entity.id
 
         # Now that all entities are upserted, sync entity relationships
-        entity_relationships_to_sync = [
-            EntityRelationship(
-                sub_entity_id=entities_map[sub_ctype.id, sub_entity_id].id,
-                super_entity_id=entities_map[super_ctype.id, super_entity_id].id,
-            )
-            for sub_ctype, super_entities_by_sub_ctype in super_entities_by_ctype.items()
-            for super_ctype, relationships in super_entities_by_sub_ctype.items()
-            for sub_entity_id, super_entity_id in relationships
-            if (sub_ctype.id, sub_entity_id) in entities_map and (super_ctype.id, super_entity_id) in entities_map
-        ]
+        entity_relationships_to_sync = []
+        for sub_ctype, super_entities_by_sub_ctype in super_entities_by_ctype.items():
+            sub_entity_ids = entity_ids_by_ctype_id[sub_ctype.id]
+            for super_ctype, relationships in super_entities_by_sub_ctype.items():
+                super_entity_ids = entity_ids_by_ctype_id[super_ctype.id]
+                entity_relationships_to_sync.extend([
+                    EntityRelationship(
+                        sub_entity_id=sub_entity_ids[sub_entity_id],
+                        super_entity_id=super_entity_ids[super_entity_id],
+                    )
+                    for sub_entity_id, super_entity_id in relationships
+                    if sub_entity_id in sub_entity_ids and super_entity_id in super_entity_ids
+                ])
 
         # Find the entities of the original model objects we were syncing. These
-        # are needed to properly sync entity relationships
-        original_entity_ids = [
-            entities_map[ctype.id, model_obj.id].id
+        # are needed to properly sync entity relationships. A model object can be listed
+        # more than once, so the ids are deduplicated in order
+        original_entity_ids = list(dict.fromkeys(
+            entity_ids_by_ctype_id[ctype.id][model_obj.id]
             for ctype, model_objs_for_ctype in model_objs_by_ctype.items()
             for model_obj in model_objs_for_ctype
-            if (ctype.id, model_obj.id) in entities_map
-        ]
+            if model_obj.id in entity_ids_by_ctype_id[ctype.id]
+        ))
 
         if self.sync_all:
             # If we're syncing everything, just sync against the entire entity relationship
             # table instead of doing a complex __in query
-            sync_against = EntityRelationship.objects.all()
+            self.upsert_entity_relationships(
+                queryset=EntityRelationship.objects.all(),
+                entity_relationships=entity_relationships_to_sync
+            )
         else:
-            sync_against = EntityRelationship.objects.filter(sub_entity_id__in=original_entity_ids)
-
-        # Sync the relations
-        self.upsert_entity_relationships(
-            queryset=sync_against,
-            entity_relationships=entity_relationships_to_sync
-        )
+            # Sync the relations of the original entities in batches so that no statement
+            # carries every entity or relationship
+            entity_relationships_by_sub_entity_id = defaultdict(list)
+            for entity_relationship in entity_relationships_to_sync:
+                entity_relationships_by_sub_entity_id[entity_relationship.sub_entity_id].append(entity_relationship)
+
+            for i in range(0, len(original_entity_ids), self.upsert_batch_size):
+                batch_entity_ids = original_entity_ids[i:i + self.upsert_batch_size]
+                self.upsert_entity_relationships(
+                    queryset=EntityRelationship.objects.filter(sub_entity_id__in=batch_entity_ids),
+                    entity_relationships=list(chain.from_iterable(
+                        entity_relationships_by_sub_entity_id[entity_id]
+                        for entity_id in batch_entity_ids
+                    ))
+                )
 
     @transaction_atomic_with_retry()
     def upsert_entity_kinds(self, entity_kinds):
@@ -436,16 +512,15 @@ class EntitySyncer(object):
             # we are syncing we still run into deadlock issues
             list(EntityKind.all_objects.all().order_by('id').select_for_update().values_list('id', flat=True))
 
-            # Upsert the entity kinds
-            upserted_enitity_kinds = manager_utils.bulk_upsert(
-                queryset=EntityKind.all_objects.filter(
-                    name__in=[entity_kind.name for entity_kind in changed_entity_kinds]
-                ),
+            # Upsert the entity kinds in a single insert on conflict statement
+            entity_kind_queryset = EntityKind.all_objects.all()
+            upserted_enitity_kinds = _get_models_from_upsert_results(entity_kind_queryset, manager_utils.bulk_upsert2(
+                queryset=entity_kind_queryset,
                 model_objs=changed_entity_kinds,
                 unique_fields=['name'],
                 update_fields=['display_name'],
-                return_upserts=True
-            )
+                returning=True
+            ))
 
         # Return all the entity kinds
         return upserted_enitity_kinds + list(unchanged_entity_kinds.values())
@@ -458,54 +533,25 @@ class EntitySyncer(object):
         :param sync: Do a sync instead of an upsert
         """
 
-        # Select the entities we are upserting for update to reduce deadlocks
-        if entities:
-            # Default select for update query when syncing all
-            select_for_update_query = (
-                'SELECT FROM {table_name} ORDER BY id ASC FOR NO KEY UPDATE'
-            ).format(
-                table_name=Entity._meta.db_table
-            )
-            select_for_update_query_params = []
-
-            # If we are not syncing all, only select those we are updating
-            if not sync:
-                select_for_update_query = (
-                    'SELECT FROM {table_name} '
-                    'WHERE (entity_type_id, entity_id) IN %s '
-                    'ORDER BY id ASC '
-                    'FOR NO KEY UPDATE'
-                ).format(
-                    table_name=Entity._meta.db_table
-                )
-                select_for_update_query_params = [tuple(
-                    (entity.entity_type_id, entity.entity_id)
-                    for entity in entities
-                )]
-
-            # Select the items for update
-            with connection.cursor() as cursor:
-                cursor.execute(select_for_update_query, select_for_update_query_params)
-
-        # Compute the initial queryset and the initial state of the entities we are syncing
+        # Compute the initial state of the entities we are syncing and the upserted entities.
         # We need the initial state so we can compare it to the new state to determine any
         # entities that were activated or deactivated
-        initial_queryset = Entity.all_objects.all()
-        if not sync:
-            initial_queryset = Entity.all_objects.extra(
-                where=['(entity_type_id, entity_id) IN %s'],
-                params=[tuple(
-                    (entity.entity_type_id, entity.entity_id)
-                    for entity in entities
-                )]
-            )
-        initial_entity_activation_state = {
-            entity[0]: entity[1]
-            for entity in initial_queryset.values_list('id', 'is_active')
-        }
+        initial_entity_activation_state = {}
+        upserted_entities = []
 
         # Sync all the entities if the sync flag is passed
         if sync:
+            # Select all the entities for update to reduce deadlocks
+            if entities:
+                with connection.cursor() as cursor:
+                    cursor.execute(
+                        'SELECT FROM {table_name} ORDER BY id ASC FOR NO KEY UPDATE'.format(
+                            table_name=Entity._meta.db_table
+                        )
+                    )
+
+            initial_queryset = Entity.all_objects.all()
+            initial_entity_activation_state.update(initial_queryset.values_list('id', 'is_active'))
             upserted_entities = manager_utils.sync(
                 queryset=initial_queryset,
                 model_objs=entities,
@@ -513,15 +559,46 @@ class EntitySyncer(object):
                 update_fields=['entity_kind_id', 'entity_meta', 'display_name', 'is_active'],
                 return_upserts=True
             )
-        # Otherwise we want to upsert our entities
+        # Otherwise we want to upsert our entities in batches. Each batch selects its entities for update,
+        # reads their initial state and upserts them, so no statement carries every entity. The entities
+        # are sorted so that concurrent syncs lock them in the same order. Rows whose fields did not
+        # change are left untouched by the database but are still returned
         else:
-            upserted_entities = manager_utils.bulk_upsert(
-                queryset=initial_queryset,
-                model_objs=entities,
-                unique_fields=['entity_type_id', 'entity_id'],
-                update_fields=['entity_kind_id', 'entity_meta', 'display_name', 'is_active'],
-                return_upserts=True
-            )
+            entities = sorted(entities, key=lambda entity: (entity.entity_type_id, entity.entity_id))
+            for i in range(0, len(entities), self.upsert_batch_size):
+                batch_entities = entities[i:i + self.upsert_batch_size]
+                batch_keys = tuple(
+                    (entity.entity_type_id, entity.entity_id)
+                    for entity in batch_entities
+                )
+
+                # Select the entities we are upserting for update to reduce deadlocks
+                with connection.cursor() as cursor:
+                    cursor.execute(
+                        (
+                            'SELECT FROM {table_name} '
+                            'WHERE (entity_type_id, entity_id) IN %s '
+                            'ORDER BY id ASC '
+                            'FOR NO KEY UPDATE'
+                        ).format(
+                            table_name=Entity._meta.db_table
+                        ),
+                        [batch_keys]
+                    )
+
+                batch_queryset = Entity.all_objects.extra(
+                    where=['(entity_type_id, entity_id) IN %s'],
+                    params=[batch_keys]
+                )
+                initial_entity_activation_state.update(batch_queryset.values_list('id', 'is_active'))
+                upserted_entities.extend(_get_models_from_upsert_results(batch_queryset, manager_utils.bulk_upsert2(
+                    queryset=batch_queryset,
+                    model_objs=batch_entities,
+                    unique_fields=['entity_type_id', 'entity_id'],
+                    update_fields=['entity_kind_id', 'entity_meta', 'display_name', 'is_active'],
+                    returning=True,
+                    return_untouched=True
+                )))
 
         # Compute the current state of the entities
         current_entity_activation_state = {
@@ -1,12 +1,13 @@
 from django.contrib.contenttypes.models import ContentType
 from django_dynamic_fixture import G, N
 from django.test import TestCase
+from unittest.mock import patch
 from entity.sync import sync_entities
 
 from entity.signal_handlers import turn_off_syncing, turn_on_syncing
 
 from entity.models import (
-    Entity, EntityKind, EntityRelationship, EntityGroup, EntityGroupMembership, get_entities_by_kind
+    Entity, EntityKind, EntityRelationship, EntityGroup, EntityGroupMembership, get_entities_by_kind,
 )
 from entity.tests.models import Account, Team, TeamGroup, Competitor
 from entity.tests.utils import EntityTestCase
@@ -78,9 +79,9 @@ class TestAllEntityManager(EntityTestCase):
         for i in range(5):
             Account.objects.create(team=team)
 
-        # Five queries should happen here - one for all entities, two for EntityRelationships,
-        # and two more for entities in the relationships
-        with self.assertNumQueries(5):
+        # Three queries should happen here - one for all entities and one for each direction of
+        # EntityRelationships, which join in the related entities
+        with self.assertNumQueries(3):
             entities = Entity.objects.cache_relationships()
             for entity in entities:
                 self.assertTrue(len(list(entity.get_super_entities())) >= 0)
@@ -96,9 +97,9 @@ class TestAllEntityManager(EntityTestCase):
         for i in range(5):
             Account.objects.create(team=team)
 
-        # Five queries should happen here - one for all entities, two for EntityRelationships,
-        # and two more for entities in the relationships
-        with self.assertNumQueries(3):
+        # Two queries should happen here - one for all entities and one for the EntityRelationships,
+        # which join in the related entities
+        with self.assertNumQueries(2):
             entities = Entity.objects.cache_relationships(cache_super=False)
             for entity in entities:
                 self.assertTrue(len(list(entity.get_sub_entities())) >= 0)
@@ -113,9 +114,9 @@ class TestAllEntityManager(EntityTestCase):
         for i in range(5):
             Account.objects.create(team=team)
 
-        # Five queries should happen here - one for all entities, two for EntityRelationships,
-        # and two more for entities in the relationships
-        with self.assertNumQueries(3):
+        # Two queries should happen here - one for all entities and one for the EntityRelationships,
+        # which join in the related entities
+        with self.assertNumQueries(2):
             entities = Entity.objects.cache_relationships(cache_sub=False)
             for entity in entities:
                 self.assertTrue(len(list(entity.get_super_entities())) >= 0)
@@ -130,13 +131,32 @@ class TestAllEntityManager(EntityTestCase):
         for i in range(5):
             Account.objects.create(team=team)
 
-        # Five queries should happen here - one for all entities, two for EntityRelationships,
-        # and two more for entities in the relationships
+        # Only the query for all entities should happen here since nothing is cached
         with self.assertNumQueries(1):
             entities = Entity.objects.cache_relationships(cache_sub=False, cache_super=False)
             self.assertTrue(len(entities) > 0)
+        queryset = Entity.objects.all()
+        self.assertIs(queryset.cache_relationships(cache_sub=False, cache_super=False), queryset)
         self.assertEqual(entities.count(), 6)
 
+    def test_manager_cache_relationships_entity_models(self):
+        """
+        Tests that the model objects of the entities and their related entities can be cached too.
+        """
+        team = Team.objects.create()
+        accounts = [Account.objects.create(team=team) for i in range(5)]
+
+        # Three queries for the entities and relationships and one for each content type of the entities
+        # in each of them
+        with self.assertNumQueries(7):
+            entities = Entity.objects.cache_relationships(cache_entity_models=True)
+            for entity in entities:
+                self.assertIn(entity.entity, [team] + accounts)
+                for super_entity in entity.get_super_entities():
+                    self.assertEqual(super_entity.entity, team)
+                for sub_entity in entity.get_sub_entities():
+                    self.assertIn(sub_entity.entity, accounts)
+
     def test_queryset_cache_relationships(self):
         """
         Tests a retrieval of cache relationships on the queryset and verifies it results in the smallest amount of
@@ -147,9 +167,9 @@ class TestAllEntityManager(EntityTestCase):
             Account.objects.create(team=team)
 
         entity_ids = [i.id for i in Entity.objects.all()]
-        # Five queries should happen here - 1 for the Entity filter, two for EntityRelationships, and two more
-        # for entities in those relationships
-        with self.assertNumQueries(5):
+        # Three queries should happen here - 1 for the Entity filter and two for EntityRelationships, which
+        # join in the entities of those relationships
+        with self.assertNumQueries(3):
             entities = Entity.objects.filter(id__in=entity_ids).cache_relationships()
             for entity in entities:
                 self.assertTrue(len(list(entity.get_super_entities())) >= 0)
@@ -165,15 +185,42 @@ class TestAllEntityManager(EntityTestCase):
         for i in range(5):
             Account.objects.create(team=team)
 
-        # Five queries should happen here - 1 for the Entity filter, two for EntityRelationships, and one more
-        # for entities in those relationships (since no sub relationships exist)
-        with self.assertNumQueries(4):
+        # Three queries should happen here - 1 for the Entity filter and two for EntityRelationships, which
+        # join in the entities of those relationships
+        with self.assertNumQueries(3):
             entities = Entity.objects.is_sub_to_all(team_entity).cache_relationships()
             for entity in entities:
                 self.assertTrue(len(list(entity.get_super_entities())) == 1)
                 self.assertTrue(len(list(entity.get_sub_entities())) == 0)
+                # The metadata of the cached entities is loaded
+                self.assertEqual(entity.get_super_entities()[0].get_deferred_fields(), set())
             self.assertEqual(len(entities), 5)
 
+    def test_cache_relationships_with_meta(self):
+        """
+        Tests that the metadata of the related entities is loaded when caching relationships.
+        """
+        team_entity = Entity.objects.get_for_obj(Team.objects.create())
+        account_entity = Entity.objects.get_for_obj(Account.objects.create(team=team_entity.entity))
+
+        with self.assertNumQueries(3):
+            entity = Entity.objects.cache_relationships().get(id=team_entity.id)
+            sub_entity = entity.get_sub_entities()[0]
+            self.assertEqual(sub_entity.get_deferred_fields(), set())
+            self.assertEqual(sub_entity.entity_meta, account_entity.entity_meta)
+
+    def test_cache_relationships_defer_meta(self):
+        """
+        Tests that the metadata of the related entities can be deferred when caching relationships.
+        """
+        team_entity = Entity.objects.get_for_obj(Team.objects.create())
+        Account.objects.create(team=team_entity.entity)
+
+        with self.assertNumQueries(3):
+            entity = Entity.objects.cache_relationships(defer_meta=True).get(id=team_entity.id)
+            self.assertEqual(entity.get_sub_entities()[0].get_deferred_fields(), {'entity_meta'})
+            self.assertEqual(entity.get_super_entities(), [])
+
     def test_get_for_obj(self):
         """
         Test retrieving an entity associated with an object.
@@ -184,6 +231,43 @@ class TestAllEntityManager(EntityTestCase):
         entity = Entity.objects.get(entity_type=ContentType.objects.get_for_model(account), entity_id=account.id)
         self.assertEqual(entity, Entity.objects.get_for_obj(account))
 
+    def test_filter_for_objs(self):
+        """
+        Tests looking up the entities of many objects of different model classes with one query.
+        """
+        team = Team.objects.create()
+        accounts = [Account.objects.create(team=team) for i in range(3)]
+        Competitor.objects.create()
+        expected = {Entity.objects.get_for_obj(obj) for obj in [team] + accounts[1:]}
+
+        with self.assertNumQueries(1):
+            self.assertEqual(set(Entity.objects.filter_for_objs([team] + accounts[1:])), expected)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(list(Entity.objects.filter_for_objs([])), [])
+
+    def test_bulk_delete_for_objs(self):
+        """
+        Tests deleting the entities of many objects of different model classes.
+        """
+        team = Team.objects.create()
+        accounts = [Account.objects.create(team=team) for i in range(3)]
+        kept_entity = Entity.objects.get_for_obj(accounts[0])
+
+        Entity.all_objects.bulk_delete_for_objs([team] + accounts[1:])
+
+        self.assertEqual(list(Entity.all_objects.all()), [kept_entity])
+
+    def test_bulk_delete_for_objs_none(self):
+        """
+        Tests that nothing is deleted when no objects are given.
+        """
+        Account.objects.create()
+
+        with self.assertNumQueries(0):
+            self.assertEqual(Entity.all_objects.bulk_delete_for_objs([]), (0, {}))
+        self.assertEqual(Entity.all_objects.count(), 1)
+
     def test_filter_manager_active(self):
         """
         Test filtering active entities directly from the manager.
@@ -329,6 +413,27 @@ class TestAllEntityManager(EntityTestCase):
         expected_names = [u'group_competitor', u'group_only', u'team_group']
         self.assertEqual(sorted_names, expected_names)
 
+    def test_is_sub_to_all_kinds_multiple_supers_of_kind(self):
+        # set up two teams and a group
+        team = Team.objects.create()
+        team2 = Team.objects.create()
+        group = TeamGroup.objects.create(name='group')
+
+        # set up players that have more than one super entity of the same kind
+        Account.objects.create(email='two_teams', team=team, team2=team2)
+        Account.objects.create(email='two_teams_group', team=team, team2=team2, team_group=group)
+        Account.objects.create(email='group_only', team_group=group)
+
+        # get kind model(s)
+        team_kind = EntityKind.objects.get(name='tests.team')
+        group_kind = EntityKind.objects.get(name='tests.teamgroup')
+
+        sorted_names = sorted([e.display_name for e in Entity.objects.is_sub_to_all_kinds(team_kind)])
+        self.assertEqual(sorted_names, [u'two_teams', u'two_teams_group'])
+
+        sorted_names = sorted([e.display_name for e in Entity.objects.is_sub_to_all_kinds(team_kind, group_kind)])
+        self.assertEqual(sorted_names, [u'two_teams_group'])
+
     def test_is_sub_to_any_kind_none(self):
         # set up teams, groups and competitors
         team = Team.objects.create()
@@ -393,6 +498,28 @@ class TestAllEntityManager(EntityTestCase):
         expected_names = [u'group_competitor', u'group_only', u'team_competitor', u'team_group', u'team_only']
         self.assertEqual(sorted_names, expected_names)
 
+    def test_is_sub_to_any_kind_chained(self):
+        team = Team.objects.create()
+        team2 = Team.objects.create()
+        group = TeamGroup.objects.create(name='group')
+        team_entity = Entity.objects.get_for_obj(team)
+
+        # set up players that have more than one super entity of the same kind
+        Account.objects.create(email='two_teams', team=team, team2=team2)
+        Account.objects.create(email='two_teams_group', team=team, team2=team2, team_group=group)
+        Account.objects.create(email='team2_group', team2=team2, team_group=group)
+
+        team_kind = EntityKind.objects.get(name='tests.team')
+        group_kind = EntityKind.objects.get(name='tests.teamgroup')
+
+        sorted_names = sorted([e.display_name for e in Entity.objects.is_sub_to_any_kind(team_kind)])
+        self.assertEqual(sorted_names, [u'team2_group', u'two_teams', u'two_teams_group'])
+
+        sorted_names = sorted([
+            e.display_name for e in Entity.objects.is_sub_to_all(team_entity).is_sub_to_any_kind(group_kind)
+        ])
+        self.assertEqual(sorted_names, [u'two_teams_group'])
+
     def test_filter_queryset_two_kinds(self):
         """
         Tests filtering by entity kind when two kinds are given on a queryset.
@@ -604,6 +731,81 @@ class TestAllEntityManager(EntityTestCase):
         # Test subset results
         self.assertEqual(set(entities_4se).difference([entities_4se[0]]), entities)
 
+    def test_is_sub_to_all_chained(self):
+        """
+        Tests that is_sub_to_all and is_sub_to_all_kinds can be chained.
+        """
+        team = Team.objects.create()
+        team_entity = Entity.objects.get_for_obj(team)
+        team2 = Team.objects.create()
+        team2_entity = Entity.objects.get_for_obj(team2)
+        team_group = TeamGroup.objects.create()
+
+        entity_both = Entity.objects.get_for_obj(Account.objects.create(team=team, team2=team2))
+        entity_all = Entity.objects.get_for_obj(Account.objects.create(team=team, team2=team2, team_group=team_group))
+        Account.objects.create(team=team)
+        entity_team2_group = Entity.objects.get_for_obj(Account.objects.create(team=team2, team_group=team_group))
+
+        self.assertEqual(
+            set(Entity.objects.is_sub_to_all(team_entity).is_sub_to_all(team2_entity)),
+            {entity_both, entity_all}
+        )
+        self.assertEqual(
+            set(Entity.objects.is_sub_to_all(team_entity, team2_entity).is_sub_to_all_kinds(
+                EntityKind.objects.get(name='tests.teamgroup'))),
+            {entity_all}
+        )
+
+        # Filtering on a single super entity or kind does not restrict the kinds counted afterwards
+        team_kind = EntityKind.objects.get(name='tests.team')
+        team_group_kind = EntityKind.objects.get(name='tests.teamgroup')
+        self.assertEqual(
+            set(Entity.objects.is_sub_to_all(team2_entity).is_sub_to_all_kinds(team_kind, team_group_kind)),
+            {entity_all, entity_team2_group}
+        )
+        self.assertEqual(
+            set(Entity.objects.is_sub_to_any_kind(team_group_kind).is_sub_to_all_kinds(team_kind, team_group_kind)),
+            {entity_all, entity_team2_group}
+        )
+
+        # Each call filters on its own subquery instead of joining the relationships into the outer query
+        chained = Entity.objects.is_sub_to_all(team_entity, team2_entity).is_sub_to_all_kinds(
+            team_kind, team_group_kind)
+        self.assertNotIn('JOIN', str(chained.query).split(' WHERE ')[0])
+        self.assertEqual(set(chained), {entity_all})
+
+    def test_is_sub_to_all_repeated_super(self):
+        """
+        Tests that repeating the same super entity or kind matches like passing it once.
+        """
+        team = Team.objects.create()
+        team_entity = Entity.objects.get_for_obj(team)
+        team2 = Team.objects.create()
+        team_kind = EntityKind.objects.get(name='tests.team')
+
+        entity_both = Entity.objects.get_for_obj(Account.objects.create(team=team, team2=team2))
+        entity_team = Entity.objects.get_for_obj(Account.objects.create(team=team))
+        Account.objects.create()
+
+        self.assertEqual(
+            sorted(Entity.objects.is_sub_to_all(team_entity, team_entity), key=lambda e: e.id),
+            [entity_both, entity_team]
+        )
+        self.assertEqual(
+            sorted(Entity.objects.is_sub_to_all_kinds(team_kind, team_kind), key=lambda e: e.id),
+            [entity_both, entity_team]
+        )
+
+        # Passing a primary key matches the same as passing its model
+        self.assertEqual(
+            sorted(Entity.objects.is_sub_to_all(team_entity, team_entity.id), key=lambda e: e.id),
+            [entity_both, entity_team]
+        )
+        self.assertEqual(
+            sorted(Entity.objects.is_sub_to_all_kinds(team_kind, team_kind.id), key=lambda e: e.id),
+            [entity_both, entity_team]
+        )
+
     def test_is_sub_to_any_none(self):
         """
         Tests the base case of is_sub_to_any on no super entities.
@@ -652,6 +854,9 @@ class TestAllEntityManager(EntityTestCase):
             set(Entity.objects.exclude(id=entities_4se[0].id).is_sub_to_any(
                 team_entity, team2_entity, team_group_entity, competitor_entity)))
 
+        # Entities matching more than one super entity are only returned once
+        self.assertEqual(Entity.objects.is_sub_to_any(team_entity, team2_entity).count(), 5)
+
     def test_is_sub_to_any_limited_results(self):
         """
         Tests the is_sub_to_any for an entity from a queryset where the is_sub_to_any returns less than all
@@ -673,6 +878,16 @@ class TestAllEntityManager(EntityTestCase):
         # Test subset results
         self.assertEqual(set(entities_w_team), set(Entity.objects.is_sub_to_any(team_entity)))
 
+    def test_defer_meta(self):
+        """
+        Tests that the metadata of the entities is only loaded when accessed.
+        """
+        team_entity = Entity.objects.get_for_obj(Team.objects.create())
+        entity = Entity.objects.defer_meta().get()
+        self.assertEqual(entity, team_entity)
+        self.assertEqual(entity.get_deferred_fields(), {'entity_meta'})
+        self.assertEqual(entity.entity_meta, team_entity.entity_meta)
+
 
 class TestEntityModel(EntityTestCase):
     """
@@ -727,6 +942,21 @@ class TestEntityModel(EntityTestCase):
         # Verify that the sub entities of the team is the account
         self.assertEqual(list(team_entity.get_sub_entities()), [account_entity])
 
+    def test_get_sub_and_super_entities_num_queries(self):
+        """
+        Tests that sub and super entities are fetched with one query each when they are not cached.
+        """
+        team = Team.objects.create()
+        for i in range(3):
+            Account.objects.create(team=team)
+        team_entity = Entity.objects.get_for_obj(team)
+        account_entity = Entity.objects.get_for_obj(Account.objects.first())
+
+        with self.assertNumQueries(1):
+            self.assertEqual(len(team_entity.get_sub_entities()), 3)
+        with self.assertNumQueries(1):
+            self.assertEqual(account_entity.get_super_entities(), [team_entity])
+
     def test_unicode(self):
         """
         Tests that the unicode method returns the display name of the entity.
@@ -913,6 +1143,16 @@ class EntityGroupAllEntitiesTest(EntityTestCase):
         expected = [e]
         self.assertEqual(result, expected)
 
+    def test_individual_entities_number_of_queries(self):
+        """
+        Groups of only individual entities do not need to look up entities by kind
+        """
+        G(EntityGroupMembership, entity_group=self.group, entity=self.super_entities[0], sub_entity_kind=None)
+        G(EntityGroupMembership, entity_group=self.group, entity=self.sub_entities[0], sub_entity_kind=None)
+        with self.assertNumQueries(1):
+            entity_ids = self.group.get_all_entities()
+        self.assertEqual(entity_ids, {self.super_entities[0].id, self.sub_entities[0].id})
+
     def test_sub_entity_group_entities_returned(self):
         e = self.super_entities[0]
         G(
@@ -951,6 +1191,35 @@ class EntityGroupAllEntitiesTest(EntityTestCase):
 
         self.assertEqual(result, expected)
 
+    def test_all_entities_chained(self):
+        """
+        The returned queryset can be filtered further, including through joins
+        """
+        G(EntityGroupMembership, entity_group=self.group, sub_entity_kind=self.kind1)
+        G(EntityGroupMembership, entity_group=self.group, entity=self.super_entities[2], sub_entity_kind=None)
+        result = list(self.group.all_entities().is_sub_to_all(self.super_entities[1]).order_by('id'))
+        self.assertEqual(result, [self.sub_entities[2]])
+
+    def test_all_entities_subquery(self):
+        """
+        The returned queryset can be used as a subquery of other models
+        """
+        G(EntityGroupMembership, entity_group=self.group, entity=self.sub_entities[0], sub_entity_kind=None)
+        entities = self.group.all_entities()
+        self.assertEqual(
+            list(EntityRelationship.objects.filter(sub_entity__in=entities).values_list('super_entity', flat=True)),
+            [self.super_entities[0].id]
+        )
+        self.assertEqual(
+            list(EntityGroupMembership.objects.filter(
+                entity__in=entities.values('id')).values_list('entity', flat=True)),
+            [self.sub_entities[0].id]
+        )
+
+    def test_no_entities_returned(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(list(self.group.all_entities()), [])
+
     def test_filters_groups(self):
         other_group = G(EntityGroup)
         e = self.super_entities[1]
@@ -984,6 +1253,49 @@ class EntityGroupAllEntitiesTest(EntityTestCase):
         with self.assertNumQueries(4):
             list(self.group.all_entities())
 
+    def test_bulk_all_entities(self):
+        e1 = self.super_entities[1]
+        e2 = self.super_entities[2]
+        sub1 = self.sub_entities[0]
+        group2 = G(EntityGroup)
+
+        G(EntityGroupMembership, entity_group=self.group,
+          entity=sub1, sub_entity_kind=None)
+        G(EntityGroupMembership, entity_group=self.group,
+          entity=e1, sub_entity_kind=self.kind1)
+        G(EntityGroupMembership, entity_group=group2,
+          entity=e2, sub_entity_kind=self.kind2)
+
+        # The caches are only built once for all of the groups
+        with self.assertNumQueries(3):
+            entities_by_group = EntityGroup.bulk_all_entities([self.group, group2])
+
+        self.assertEqual(entities_by_group, {
+            self.group: {sub1.id, self.sub_entities[2].id},
+            group2: {self.sub_entities[4].id, self.sub_entities[5].id},
+        })
+
+        entities_by_group = EntityGroup.bulk_all_entities([self.group, group2], return_models=True)
+        self.assertEqual(set(entities_by_group[group2]), set(group2.all_entities()))
+
+    def test_bulk_all_entities_individual_entities(self):
+        group2 = G(EntityGroup)
+        G(EntityGroupMembership, entity_group=self.group, entity=self.sub_entities[0], sub_entity_kind=None)
+        G(EntityGroupMembership, entity_group=group2, entity=self.sub_entities[1], sub_entity_kind=None)
+
+        # Groups of only individual entities do not need to look up entities by kind
+        with self.assertNumQueries(1):
+            entities_by_group = EntityGroup.bulk_all_entities([self.group, group2])
+
+        self.assertEqual(entities_by_group, {
+            self.group: {self.sub_entities[0].id},
+            group2: {self.sub_entities[1].id},
+        })
+
+    def test_bulk_all_entities_no_groups(self):
+        with self.assertNumQueries(0):
+            self.assertEqual(EntityGroup.bulk_all_entities([]), {})
+
 
 class EntityGroupAddEntityTest(EntityTestCase):
     def test_adds_entity(self):
@@ -1056,6 +1368,29 @@ class EntityGroupBulkRemoveEntitiesTest(EntityTestCase):
         with self.assertNumQueries(2):
             self.group.bulk_remove_entities([(self.e3, self.k), (self.e2, None)])
 
+    def test_removes_all_of_kind(self):
+        self.group.bulk_add_entities([(None, self.k)])
+        self.group.bulk_remove_entities([(None, self.k), (self.e1, self.k)])
+        self.assertEqual(
+            set(EntityGroupMembership.objects.filter(entity_group=self.group).values_list(
+                'entity_id', 'sub_entity_kind_id')),
+            {(self.e2.id, None), (self.e3.id, self.k.id), (self.e3.id, None)}
+        )
+
+    def test_removes_null_memberships(self):
+        self.group.bulk_add_entities([(None, None)])
+        self.group.bulk_remove_entities([(None, None)])
+        self.assertEqual(
+            EntityGroupMembership.objects.filter(entity_group=self.group, entity=None, sub_entity_kind=None).count(),
+            0
+        )
+        self.assertEqual(EntityGroupMembership.objects.filter(entity_group=self.group).count(), 4)
+
+    def test_nothing_to_remove(self):
+        with self.assertNumQueries(0):
+            self.group.bulk_remove_entities([])
+        self.assertEqual(EntityGroupMembership.objects.filter(entity_group=self.group).count(), 4)
+
 
 class EntityGroupBulkOverwriteEntitiesTest(EntityTestCase):
     def setUp(self):
@@ -1080,6 +1415,76 @@ class EntityGroupBulkOverwriteEntitiesTest(EntityTestCase):
         count = EntityGroupMembership.objects.filter(entity_group=group).count()
         self.assertEqual(count, 1)
 
+    def test_bulk_overwrite_keeps_unchanged(self):
+        unchanged = EntityGroupMembership.objects.get(entity_group=self.group, entity=self.e1, sub_entity_kind=self.k)
+        memberships = self.group.bulk_overwrite([(self.e1, self.k), (self.e2, self.k), (None, self.k)])
+
+        self.assertEqual(
+            [(membership.entity_id, membership.sub_entity_kind_id) for membership in memberships],
+            [(self.e1.id, self.k.id), (self.e2.id, self.k.id), (None, self.k.id)]
+        )
+        self.assertEqual(memberships[0].id, unchanged.id)
+        self.assertEqual(
+            set(EntityGroupMembership.objects.filter(entity_group=self.group).values_list(
+                'entity_id', 'sub_entity_kind_id')),
+            {(self.e1.id, self.k.id), (self.e2.id, self.k.id), (None, self.k.id)}
+        )
+
+    def test_bulk_overwrite_duplicates(self):
+        # An existing duplicate membership is removed and duplicate pairs are kept
+        self.group.bulk_add_entities([(self.e2, None)])
+        memberships = self.group.bulk_overwrite([(self.e2, None), (self.e1, None), (self.e1, None)])
+
+        self.assertEqual(
+            [(membership.entity_id, membership.sub_entity_kind_id) for membership in memberships],
+            [(self.e2.id, None), (self.e1.id, None), (self.e1.id, None)]
+        )
+        self.assertEqual(
+            sorted(EntityGroupMembership.objects.filter(entity_group=self.group).values_list(
+                'entity_id', 'sub_entity_kind_id')),
+            sorted([(self.e2.id, None), (self.e1.id, None), (self.e1.id, None)])
+        )
+
+    def test_bulk_overwrite_rolls_back(self):
+        existing = set(EntityGroupMembership.objects.filter(entity_group=self.group).values_list(
+            'entity_id', 'sub_entity_kind_id'))
+
+        with patch.object(EntityGroupMembership.objects, 'bulk_create', side_effect=ValueError):
+            with self.assertRaises(ValueError):
+                self.group.bulk_overwrite([(self.e3, None)])
+
+        # The removed memberships are restored when adding fails
+        self.assertEqual(
+            set(EntityGroupMembership.objects.filter(entity_group=self.group).values_list(
+                'entity_id', 'sub_entity_kind_id')),
+            existing
+        )
+
+    def test_bulk_overwrite_returns_saved_memberships(self):
+        memberships = self.group.bulk_overwrite([(self.e3, None), (self.e1, self.k), (self.e2, None)])
+
+        # Every given pair is returned in order and each returned membership is saved in the group
+        self.assertEqual(
+            [(membership.entity_id, membership.sub_entity_kind_id) for membership in memberships],
+            [(self.e3.id, None), (self.e1.id, self.k.id), (self.e2.id, None)]
+        )
+        self.assertEqual(
+            set(EntityGroupMembership.objects.filter(entity_group=self.group).values_list('id', flat=True)),
+            {membership.id for membership in memberships}
+        )
+
+    def test_bulk_overwrite_logic_string(self):
+        self.group.logic_string = '1 AND 2'
+        self.group.save()
+        self.group.bulk_overwrite([(self.e3, None), (self.e1, self.k)])
+
+        # The memberships are recreated in the given order
+        self.assertEqual(
+            list(EntityGroupMembership.objects.filter(entity_group=self.group).order_by('id').values_list(
+                'entity_id', 'sub_entity_kind_id')),
+            [(self.e3.id, None), (self.e1.id, self.k.id)]
+        )
+
 
 class EntityGroupTest(TestCase):
 
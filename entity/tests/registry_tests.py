@@ -41,6 +41,28 @@ class EntityRegistryTest(TestCase):
         entity_registry_info = entity_registry._entity_registry[ValidRegistryModel]
         self.assertTrue(isinstance(entity_registry_info, ValidEntityConfig))
 
+    def test_register_updates_model_snapshots(self):
+        """
+        Tests that registering an entity config rebuilds the registered and watching model sets.
+        """
+        class ValidRegistryModel(Model):
+            pass
+
+        class WatchedRegistryModel(Model):
+            pass
+
+        class ValidEntityConfig(EntityConfig):
+            queryset = ValidRegistryModel.objects.all()
+            watching = [(WatchedRegistryModel, lambda model_obj: [])]
+
+        entity_registry = EntityRegistry()
+        self.assertEqual(entity_registry.registered_models, frozenset())
+        self.assertEqual(entity_registry.watching_models, frozenset())
+
+        entity_registry.register_entity(ValidEntityConfig)
+        self.assertEqual(entity_registry.registered_models, frozenset([ValidRegistryModel]))
+        self.assertEqual(entity_registry.watching_models, frozenset([WatchedRegistryModel]))
+
     def test_register_invalid_entity_config(self):
         """
         Tests registering an invalid entity config that does not inherit EntityConfig
@@ -4,12 +4,14 @@ Provides tests for the syncing functionalities in django entity.
 from django import db
 from django.contrib.contenttypes.models import ContentType
 from django.core.management import call_command
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
 from django_dynamic_fixture import G
 from entity.config import EntityRegistry
 from entity.models import Entity, EntityRelationship, EntityKind
 from entity.sync import (
     sync_entities, defer_entity_syncing, transaction_atomic_with_retry, _get_super_entities_by_ctype,
-    suppress_entity_syncing,
+    suppress_entity_syncing, sync_entities_watching, EntitySyncer,
 )
 from entity.signal_handlers import turn_on_syncing, turn_off_syncing
 from unittest.mock import patch, MagicMock, call, Mock
@@ -182,6 +184,20 @@ class SyncAllEntitiesTest(EntityTestCase):
         call_command('sync_entities')
         self.assertEqual(Entity.objects.all().count(), 5)
 
+    def test_sync_all_loads_content_types_once(self):
+        """
+        Tests that syncing all entities loads the content types of the registered models in one query.
+        """
+        turn_off_syncing()
+        Account.objects.create(team=Team.objects.create())
+        turn_on_syncing()
+        ContentType.objects.clear_cache()
+
+        with CaptureQueriesContext(db.connection) as captured:
+            sync_entities()
+        self.assertEqual(len([q for q in captured if 'django_content_type' in q['sql']]), 1)
+        self.assertEqual(Entity.objects.count(), 2)
+
     def test_sync_dummy_data(self):
         """
         Tests that dummy data (i.e data that does not inherit EntityModelMixin) doesn't
@@ -523,6 +539,23 @@ class TestWatching(EntityTestCase):
             sub_entity=points_to_m2m_entity, super_entity=team_entity).exists())
         self.assertTrue(EntityRelationship.objects.filter(sub_entity=m2m_entity, super_entity=team_entity).exists())
 
+    @patch('entity.sync.sync_entities')
+    def test_multiple_watchers_synced_once(self, mock_sync_entities):
+        """
+        Tests that the model objects of every entity watching a model are synced with one call.
+        """
+        team = G(Team)
+        account = G(Account)
+        pta = G(PointsToAccount)
+        entity_watching = {
+            Team: [(Account, lambda team_obj: [account]), (PointsToAccount, lambda team_obj: [pta])],
+        }
+
+        with patch('entity.sync.entity_registry', entity_watching=entity_watching):
+            sync_entities_watching(team)
+
+        mock_sync_entities.assert_called_once_with(account, pta)
+
     def test_points_to_account_config_competitor_updated(self):
         """
         Tests that a PointsToAccount model is updated when the competitor of its account is updated.
@@ -919,6 +952,87 @@ class TestSyncingMultipleEntities(EntityTestCase):
         self.assertEqual(Entity.objects.count(), 3)
         self.assertEqual(EntityRelationship.objects.count(), 2)
 
+    @override_settings(ENTITY_SYNC_BATCH_SIZE=1)
+    def test_sync_two_accounts_in_batches(self):
+        """
+        Tests that the entities and relationships are all synced when they are written in several batches.
+        """
+        turn_off_syncing()
+        team = G(Team)
+        account1 = G(Account, team=team)
+        account2 = G(Account, team=team)
+        sync_entities(account1, account2)
+
+        self.assertEqual(Entity.objects.count(), 3)
+        self.assertEqual(EntityRelationship.objects.count(), 2)
+
+        # Move one account to another team and check that the old relationship is removed
+        account1.team = G(Team)
+        account1.save()
+        sync_entities(account1, account2)
+
+        self.assertEqual(Entity.objects.count(), 4)
+        self.assertEqual(
+            set(EntityRelationship.objects.values_list('sub_entity__entity_id', 'super_entity__entity_id')),
+            {(account1.id, account1.team.id), (account2.id, team.id)}
+        )
+
+    def test_batch_size_setting(self):
+        """
+        Tests that the batch size can be changed with a setting.
+        """
+        self.assertEqual(EntitySyncer().upsert_batch_size, EntitySyncer.upsert_batch_size)
+        with override_settings(ENTITY_SYNC_BATCH_SIZE=5):
+            self.assertEqual(EntitySyncer().upsert_batch_size, 5)
+
+    def test_upsert_entities_returns_entities(self):
+        """
+        Tests that entities are returned whether or not the entities are synced.
+        """
+        turn_off_syncing()
+        account = G(Account)
+        sync_entities(account)
+        entity = Entity.objects.get_for_obj(account)
+
+        for sync in (False, True):
+            upserted_entities, changed_entity_activation_state = EntitySyncer().upsert_entities([Entity(
+                entity_type_id=entity.entity_type_id,
+                entity_id=entity.entity_id,
+                entity_kind_id=entity.entity_kind_id,
+                entity_meta={'sync': sync},
+                display_name=entity.display_name,
+                is_active=True,
+            )], sync=sync)
+
+            self.assertEqual(len(upserted_entities), 1)
+            self.assertIsInstance(upserted_entities[0], Entity)
+            self.assertEqual(upserted_entities[0].id, entity.id)
+            self.assertEqual(upserted_entities[0].entity_meta, {'sync': sync})
+            self.assertEqual(changed_entity_activation_state, {})
+
+    def test_upsert_entity_kinds_returns_entity_kinds(self):
+        """
+        Tests that entity kinds are returned whether or not they changed.
+        """
+        G(EntityKind, name='unchanged', display_name='Unchanged')
+        G(EntityKind, name='changed', display_name='Old')
+
+        upserted_entity_kinds = EntitySyncer().upsert_entity_kinds([
+            EntityKind(name='unchanged', display_name='Unchanged'),
+            EntityKind(name='changed', display_name='New'),
+            EntityKind(name='created', display_name='Created'),
+        ])
+
+        self.assertTrue(all(isinstance(entity_kind, EntityKind) for entity_kind in upserted_entity_kinds))
+        self.assertEqual(
+            {(entity_kind.name, entity_kind.display_name) for entity_kind in upserted_entity_kinds},
+            {('unchanged', 'Unchanged'), ('changed', 'New'), ('created', 'Created')}
+        )
+        self.assertEqual(
+            {entity_kind.id for entity_kind in upserted_entity_kinds},
+            set(EntityKind.objects.filter(name__in=['unchanged', 'changed', 'created']).values_list('id', flat=True))
+        )
+
     def test_sync_two_accounts_one_team_group(self):
         turn_off_syncing()
         team = G(Team)
@@ -930,6 +1044,62 @@ class TestSyncingMultipleEntities(EntityTestCase):
         self.assertEqual(Entity.objects.count(), 4)
         self.assertEqual(EntityRelationship.objects.count(), 2)
 
+    def test_sync_batched_config_hook_wrong_length(self):
+        """
+        Tests that an error is raised when a config hook does not return a value for every model object.
+        """
+        turn_off_syncing()
+        team = G(Team)
+        account1 = G(Account, team=team)
+        account2 = G(Account, team=team)
+        with patch.object(AccountConfig, 'get_display_names', autospec=True, return_value=['one']):
+            with self.assertRaisesRegex(ValueError, 'AccountConfig.get_display_names returned 1 values for 2'):
+                sync_entities(account1, account2)
+
+    def test_sync_batched_config_hook_generator(self):
+        """
+        Tests that a config hook can return any iterable of values.
+        """
+        turn_off_syncing()
+        account = G(Account)
+        with patch.object(AccountConfig, 'get_display_names', autospec=True, return_value=iter(['one'])):
+            sync_entities(account)
+
+        self.assertEqual(Entity.objects.get_for_obj(account).display_name, 'one')
+
+    def test_sync_entity_kinds_computed_once(self):
+        """
+        Tests that the entity kinds of the synced models are only computed once.
+        """
+        turn_off_syncing()
+        team = G(Team)
+        account = G(Account, team=team)
+        with patch.object(AccountConfig, 'get_entity_kinds', autospec=True, return_value=[('a', 'A')]) as mock:
+            sync_entities(account)
+
+        self.assertEqual(mock.call_count, 1)
+        self.assertEqual(Entity.objects.get_for_obj(account).entity_kind.name, 'a')
+
+    def test_sync_two_accounts_batched_config_hooks(self):
+        """
+        Tests that the config hooks are called once with every model object of an entity type.
+        """
+        turn_off_syncing()
+        team = G(Team)
+        account1 = G(Account, team=team, email='a1@example.com')
+        account2 = G(Account, team=team, email='a2@example.com')
+        with patch.object(AccountConfig, 'get_display_names', autospec=True, return_value=['one', 'two']) as mock:
+            sync_entities(account1, account2)
+
+        self.assertEqual(mock.call_count, 1)
+        self.assertEqual(set(mock.call_args[0][1]), {account1, account2})
+        self.assertEqual(
+            set(Entity.objects.filter(
+                entity_type=ContentType.objects.get_for_model(Account)
+            ).values_list('display_name', flat=True)),
+            {'one', 'two'}
+        )
+
 
 class TestCachingAndCascading(EntityTestCase):
     """
@@ -957,7 +1127,7 @@ class TestCachingAndCascading(EntityTestCase):
         team_group = G(TeamGroup)
 
         ContentType.objects.clear_cache()
-        with self.assertNumQueries(15):
+        with self.assertNumQueries(14):
             team_group.save()
 
     def test_optimal_queries_registered_entity_w_qset(self):
@@ -967,7 +1137,7 @@ class TestCachingAndCascading(EntityTestCase):
         account = G(Account)
 
         ContentType.objects.clear_cache()
-        with self.assertNumQueries(18):
+        with self.assertNumQueries(17):
             account.save()
 
     def test_sync_all_optimal_queries(self):
@@ -996,7 +1166,7 @@ class TestCachingAndCascading(EntityTestCase):
         with patch('entity.sync.entity_registry') as mock_entity_registry:
             mock_entity_registry.entity_registry = new_registry.entity_registry
             ContentType.objects.clear_cache()
-            with self.assertNumQueries(20):
+            with self.assertNumQueries(19):
                 sync_entities()
 
         self.assertEqual(Entity.objects.filter(entity_type=ContentType.objects.get_for_model(Account)).count(), 5)